@@ -1,16 +1,24 @@
-import json
+import logging
 import os
-from typing import Dict, Optional, List
-
-from pydantic import BaseModel, ConfigDict
+import sys
+import time
+from functools import lru_cache
+from threading import Lock, RLock
+from typing import Dict, Optional, List, Tuple, Any, Type, TypeVar, Union, get_args, get_origin, get_type_hints
+
+import orjson
+from oauthlib.oauth2 import OAuth2Error
+from pydantic import BaseModel, ConfigDict, PrivateAttr
+from requests import RequestException
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 
 
-# import logging
-# import sys
-# log = logging.getLogger('requests_oauthlib')
-# log.addHandler(logging.StreamHandler(sys.stdout))
-# log.setLevel(logging.DEBUG)
+# set DIGIKEY_DEBUG to log all OAuth2 traffic, off by default since it serializes every (large) response
+if os.environ.get('DIGIKEY_DEBUG'):
+    log = logging.getLogger('requests_oauthlib')
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.DEBUG)
 
 
 # DigiKey API implementation for Python, using Pydantic for deserialization
@@ -18,12 +26,56 @@ from requests_oauthlib import OAuth2Session
 # and https://requests-oauthlib.readthedocs.io/en/latest/oauth2_workflow.html
 
 
+ModelType = TypeVar('ModelType', bound=BaseModel)
+
+
+@lru_cache(maxsize=None)
+def _model_type_hints(model: Type[BaseModel]) -> Dict[str, Any]:
+    return get_type_hints(model)  # resolves forward references like CategoryNode.ChildCategories
+
+
+def _construct_value(annotation: Any, value: Any) -> Any:
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel) and isinstance(value, dict):
+        return construct_model(annotation, value)
+    origin = get_origin(annotation)
+    if origin is list and isinstance(value, list):
+        elt_annotation, = get_args(annotation)
+        return [_construct_value(elt_annotation, elt) for elt in value]
+    elif origin is Union:  # including Optional
+        for arg_annotation in get_args(annotation):
+            if arg_annotation is not type(None):
+                return _construct_value(arg_annotation, value)
+    return value
+
+
+def construct_model(model: Type[ModelType], data: Dict[str, Any]) -> ModelType:
+    """Builds a model, including nested models, from trusted data (like API responses) without validation.
+    Much faster than model_validate_json, but does no type checking or coercion."""
+    type_hints = _model_type_hints(model)
+    values = {}
+    for name, value in data.items():
+        if name in model.model_fields:
+            value = _construct_value(type_hints[name], value)
+        values[name] = value  # extra fields are kept as-is, and only retained for extra="allow" models
+    return model.model_construct(**values)
+
+
 class DigiKeyApiConfig(BaseModel):
     client_id: str
     client_secret: str
     redirect_url: str = "https://localhost"
 
 
+class CachedJsonModel(BaseModel):
+    """Model which caches its JSON serialization, for responses which are re-used from the cache but never modified."""
+    _json: Optional[str] = PrivateAttr(default=None)
+
+    def model_dump_json_cached(self) -> str:
+        if self._json is None:
+            self._json = self.model_dump_json()
+        return self._json
+
+
 # Below are response formats as Pydantic models. Commented out fields are not implemented.
 class Description(BaseModel):
     ProductDescription: str
@@ -83,11 +135,11 @@ class Product(BaseModel):
     # Classifications
 
 
-class ProductDetails(BaseModel):
+class ProductDetails(CachedJsonModel):
     Product: Product
 
 
-class ProductBarcodeResponse(BaseModel):
+class ProductBarcodeResponse(CachedJsonModel):
     """https://developer.digikey.com/products/barcode/barcoding/productbarcode"""
     DigiKeyPartNumber: str
     ManufacturerPartNumber: str
@@ -96,7 +148,7 @@ class ProductBarcodeResponse(BaseModel):
     Quantity: int
 
 
-class Product2dBarcodeResponse(BaseModel):
+class Product2dBarcodeResponse(CachedJsonModel):
     """https://developer.digikey.com/products/barcode/barcoding/product2dbarcode"""
     DigiKeyPartNumber: str
     ManufacturerPartNumber: str
@@ -113,32 +165,47 @@ class Product2dBarcodeResponse(BaseModel):
 
 class DigiKeyApi():
     """DigiKey API implementation, initializing Oauth2 in the constructor.
-    Optionally pass in a saved token to skip the Oauth2 flow."""
+    Optionally pass in a saved token to skip the Oauth2 flow.
+    Responses are cached, since the same parts are frequently re-scanned."""
     kOauthCodePostfix = 'v1/oauth2/authorize'
     kOauthTokenPostfix = 'v1/oauth2/token'
+    kPoolSize = 4  # concurrent connections kept alive to the API, for overlapping requests from multiple threads
+    kCacheTtlSec = 60 * 60  # cached responses are re-fetched after this long
+    kCacheSize = 512  # maximum cached responses, after which the oldest is evicted
+    kRequestTimeoutSec = 10  # so a stalled request doesn't hold up a pool worker indefinitely
+    kTokenRefreshMarginSec = 60  # token is refreshed this long before it expires
 
     def __init__(self, api_config: DigiKeyApiConfig, token_filename: Optional[str] = None, sandbox: bool = False,
                  locale_language='en', locale_site='US'):
-        self._locale_language = locale_language
-        self._locale_site = locale_site
+        # request headers are constant, so built once here
+        self._base_headers = {'X-DIGIKEY-Client-Id': api_config.client_id}
+        self._detail_headers = {**self._base_headers,
+                                'X-DIGIKEY-Locale-Language': locale_language,
+                                'X-DIGIKEY-Locale-Site': locale_site}
+
+        self._cache: Dict[str, Tuple[float, BaseModel]] = {}  # url -> (fetch time, response), oldest first
+        self._cache_lock = Lock()  # requests may be issued from multiple threads
+        # OAuth2Session doesn't lock its auto-refresh, so concurrent requests could each refresh with the same
+        # refresh token and interleave saving the token. Reentrant since refreshing also saves the token.
+        self._token_lock = RLock()
 
         if sandbox:
             self._api_prefix = "https://sandbox-api.digikey.com/"
         else:
             self._api_prefix = "https://api.digikey.com/"
+        self._refresh_url = self._api_prefix + self.kOauthTokenPostfix
+        self._refresh_kwargs = {'client_id': api_config.client_id, 'client_secret': api_config.client_secret}
 
         self._token_filename = token_filename
         if os.path.exists(self._token_filename):
-            with open(self._token_filename) as f:
-                token = json.load(f)
+            with open(self._token_filename, 'rb') as f:
+                token = orjson.loads(f.read())
         else:
             token = None
 
         if token is None:
             self._oauth = OAuth2Session(api_config.client_id, redirect_uri=api_config.redirect_url,
-                                        auto_refresh_url=self._api_prefix + self.kOauthTokenPostfix,
-                                        auto_refresh_kwargs={'client_id': api_config.client_id,
-                                                             'client_secret': api_config.client_secret},
+                                        auto_refresh_url=self._refresh_url, auto_refresh_kwargs=self._refresh_kwargs,
                                         token_updater=self.token_saver)
             authorization_url, state = self._oauth.authorization_url(self._api_prefix + self.kOauthCodePostfix)
             response = input(f"Go to {authorization_url} in your browser and paste the returned URL, e.g. https://localhost/?code=...&...: ")
@@ -148,39 +215,62 @@ class DigiKeyApi():
             self.token_saver(token)
         else:
             self._oauth = OAuth2Session(api_config.client_id, redirect_uri=api_config.redirect_url,
-                                        auto_refresh_url=self._api_prefix + self.kOauthTokenPostfix,
-                                        auto_refresh_kwargs={'client_id': api_config.client_id,
-                                                             'client_secret': api_config.client_secret},
+                                        auto_refresh_url=self._refresh_url, auto_refresh_kwargs=self._refresh_kwargs,
                                         token=token, token_updater=self.token_saver)
+        self._oauth.mount(self._api_prefix, HTTPAdapter(pool_connections=self.kPoolSize, pool_maxsize=self.kPoolSize))
 
     def token_saver(self, token: Dict[str, str]):
-        with open(self._token_filename, 'w') as f:
-            json.dump(token, f)
+        with self._token_lock:
+            with open(self._token_filename, 'wb') as f:
+                f.write(orjson.dumps(token))
+
+    def _refresh_token_if_expiring(self) -> None:
+        """Refreshes the token once, under a lock, if it is about to expire. Otherwise concurrent requests would each
+        hit the expiry and auto-refresh with the same refresh token."""
+        with self._token_lock:
+            expires_at = self._oauth.token.get('expires_at')
+            if expires_at is not None and expires_at - time.time() < self.kTokenRefreshMarginSec:
+                self.token_saver(self._oauth.refresh_token(self._refresh_url, timeout=self.kRequestTimeoutSec,
+                                                          **self._refresh_kwargs))
 
     def escape_data(self, data: str) -> str:
         return data.replace('/', '%2F').replace('#', '%23')
 
+    def _get(self, url: str, headers: Dict[str, str], model: Type[ModelType]) -> ModelType:
+        """Fetches and parses an API response, or returns the cached response if recent."""
+        now = time.monotonic()
+        with self._cache_lock:
+            cached = self._cache.get(url)
+        if cached is not None and now - cached[0] < self.kCacheTtlSec:
+            return cached[1]
+
+        try:
+            self._refresh_token_if_expiring()
+            response = self._oauth.get(url, headers=headers, timeout=self.kRequestTimeoutSec)
+        except (RequestException, OAuth2Error) as e:  # reported like error responses, so callers skip the lookup
+            raise AssertionError(f"request failed: {e}") from e
+        assert response.status_code == 200, f"error response {response}: {response.text}"
+        parsed = construct_model(model, orjson.loads(response.content))
+        with self._cache_lock:
+            self._cache.pop(url, None)  # re-insert as newest
+            self._cache[url] = (now, parsed)
+            if len(self._cache) > self.kCacheSize:
+                del self._cache[next(iter(self._cache))]
+        return parsed
+
     def barcode2d(self, barcode: str) -> Product2dBarcodeResponse:
         """Product 2d barcode API, taking in the raw scanned barcode with original (un-escaped) special symbols."""
         barcode = self.escape_data(barcode)
-        response = self._oauth.get(self._api_prefix + f"Barcoding/v3/Product2DBarcodes/{barcode}",
-                                   headers={'X-DIGIKEY-Client-Id': self._oauth.client_id})
-        assert response.status_code == 200, f"error response {response}: {response.text}"
-        return Product2dBarcodeResponse.model_validate_json(response.text)
+        return self._get(self._api_prefix + f"Barcoding/v3/Product2DBarcodes/{barcode}", self._base_headers,
+                         Product2dBarcodeResponse)
 
     def barcode(self, barcode: str) -> ProductBarcodeResponse:
         """Product (1d / linear) barcode API, taking in the raw scanned barcode."""
-        response = self._oauth.get(self._api_prefix + f'Barcoding/v3/ProductBarcodes/{barcode}',
-                                   headers={'X-DIGIKEY-Client-Id': self._oauth.client_id})
-        assert response.status_code == 200, f"error response {response}: {response.text}"
-        return ProductBarcodeResponse.model_validate_json(response.text)
+        return self._get(self._api_prefix + f'Barcoding/v3/ProductBarcodes/{barcode}', self._base_headers,
+                         ProductBarcodeResponse)
 
     def product_details(self, product_number: str) -> ProductDetails:
         """Product details API, taking in a manufacture or DigiKey part number."""
         product_number = self.escape_data(product_number)
-        response = self._oauth.get(self._api_prefix + f"products/v4/search/{product_number}/productdetails",
-                                   headers={'X-DIGIKEY-Client-Id': self._oauth.client_id,
-                                            'X-DIGIKEY-Locale-Language': self._locale_language,
-                                            'X-DIGIKEY-Locale-Site': self._locale_site})
-        assert response.status_code == 200, f"error response {response}: {response.text}"
-        return ProductDetails.model_validate_json(response.text)
+        return self._get(self._api_prefix + f"products/v4/search/{product_number}/productdetails", self._detail_headers,
+                         ProductDetails)
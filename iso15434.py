@@ -1,10 +1,14 @@
 # Implementation of the ISO/IEC 15434 / EIGP144 coding standard for barcodes for labeling electronic parts
 # https://www.ecianow.org/assets/docs/GIPC/EIGP-114.2018%20ECIA%20Labeling%20Specification%20for%20Product%20and%20Shipment%20Identification%20in%20the%20Electronics%20Industry%20-%202D%20Barcode.pdf
+import re
+from functools import lru_cache
 from typing import Dict, Union, Optional, Type
 
 
 class Iso15434Record:
   """Abstract base class for records"""
+  __slots__ = ('identifier', 'raw')
+
   def __init__(self, identifier: str, raw: str):
     self.identifier = identifier
     self.raw = raw.replace('\u2420', ' ')
@@ -15,6 +19,8 @@ class Iso15434Record:
 
 class Iso15434Field:
   """Abstract base class for fields definitions"""
+  __slots__ = ('name', 'identifier', 'ctor')
+
   def __init__(self, name: str, identifier: str, ctor: Type[Iso15434Record] = Iso15434Record):
     self.name = name
     self.identifier = identifier
@@ -42,6 +48,12 @@ FieldManufacturer = Iso15434Field('Manufacturer', '1V')
 FieldRohsCc = Iso15434Field('RoHS/CC', 'E')
 
 
+# data element identifier (optional numeric prefix, then a single non-numeric character) and data
+_IDENTIFIER_RE = re.compile(r'(\d*\D)(.*)', re.DOTALL)
+# all (identifier, data) pairs from group separator delimited data elements, does not handle malformed elements
+_DATA_ELEMENTS_RE = re.compile(r'(\d*[^\d\u241d])([^\u241d]*)')
+
+
 class Iso15434:
   kAllFields = [
     FieldPo,
@@ -70,7 +82,10 @@ class Iso15434:
   kTrailer = kRecordSeparator + kEndOfTransmission
 
   @classmethod
+  @lru_cache(maxsize=512)
   def from_data(cls, data: str) -> Optional['Iso15434']:
+    """Parses barcode data, returning None if not ISO15434.
+    Results are cached since the same barcode is frequently re-scanned, and should not be modified."""
     # canonicalize the separator special characters
     data = data.replace('\x1e', '\u241e').replace('\x1d', '\u241d').replace('\x04', '\u2404')
 
@@ -80,19 +95,20 @@ class Iso15434:
     if data.endswith(cls.kTrailer):  # digikey doesn't have this, so this is optional even if nonstandard
       data = data[:-len(cls.kTrailer)]
 
+    # fast path for well-formed data, which is all elements found by the regex with nothing in between
+    identifier_elements = _DATA_ELEMENTS_RE.findall(data)
+    if cls.kGroupSeparator.join(identifier + data_element for identifier, data_element in identifier_elements) != data:
+      identifier_elements = []  # otherwise fall back to parsing element-by-element, skipping malformed ones
+      for data_element in data.split(cls.kGroupSeparator):
+        match = _IDENTIFIER_RE.match(data_element)
+        if match is not None:
+          identifier_elements.append(match.groups())
+
+    fields_by_identifier = cls.kFieldsByIdentifier
     data_elements = {}
-    for data_element in data.split(Iso15434.kGroupSeparator):
-      identifier = ''
-      while data_element and data_element[0].isnumeric():
-        identifier += data_element[0]
-        data_element = data_element[1:]
-      if not data_element:
-        continue
-      identifier += data_element[0]
-      data_element = data_element[1:]
-
-      if identifier in Iso15434.kFieldsByIdentifier:
-        field = Iso15434.kFieldsByIdentifier[identifier]
+    for identifier, data_element in identifier_elements:
+      field = fields_by_identifier.get(identifier)
+      if field is not None:
         ctor = field.ctor
       else:
         field = identifier
@@ -1,4 +1,4 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple, List, Union, Callable
 
 import argparse
 import os
@@ -7,27 +7,44 @@ import cv2
 import zxingcpp
 import numpy as np
 import datetime
+import time
 import sys
-import beepy
+import selectors
+import simpleaudio
 import serial
 
-from queue import Queue
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from queue import Queue, Full, Empty
+from threading import Thread, Event
 
 from digikey_api import DigiKeyApi, DigiKeyApiConfig
-from iso15434 import Iso15434, FieldSupplierPartNumber, FieldQuantity
+from iso15434 import Iso15434, FieldCustomerPartNumber, FieldSupplierPartNumber, FieldQuantity
 
 
 # Scanner / OpenCV configurations
 kWindowName = "PartsScanner"
-kFrameWidth = 1920
-kFrameHeight = 1080
-kRoiWidth = 280  # center-aligned region-of-interest - speeds up scanning
-kRoiHeight = kRoiWidth
+kFrameWidth = 1280  # default capture resolution, only the RoI is decoded so higher resolution is mostly wasted
+kFrameHeight = 720
+kRoiFrameFraction = 280 / 1080  # center-aligned square RoI size relative to frame height - speeds up scanning
+kRoiMinDecodeSize = 140  # RoI is downscaled to no smaller than this (px) before processing, for speed
+kRoiFullScaleRetryFrames = 8  # after this many consecutive downscaled frames without results, retry at full scale
+kStaticThumbSize = (32, 32)  # RoI is thumbnailed to this to detect an unchanged scene
+kStaticDiffThreshold = 3  # mean absolute thumbnail difference from the decoded RoI below which RoI is unchanged
+kBlankStdThreshold = 10  # RoI with pixel standard deviation below this in all channels is blank and not decoded
 
 kFontScale = 0.5
+kDisplayEveryFrames = 2  # frames are only drawn and displayed at this interval, since GUI updates are expensive
+kFpsIntervalSec = 1.0  # debug frame rate is averaged and its text updated at this interval
 
-kBarcodeTimeoutThreshold = datetime.timedelta(seconds=4)  # after not seeing a barcode for this long, count as a new one
+kBeepSampleRate = 44100
+kBeepNotes = [(988, 0.08), (1319, 0.3)]  # scan beep as (frequency Hz, duration sec) notes, a short rising chime
+
+kBarcodeTimeoutSec = 4.0  # after not seeing a barcode for this long, count as a new one
+kLastSeenPurgeIntervalSec = 1.0  # how often to purge barcodes not seen for a while from antiduplication
+kLastSeenPurgeAgeSec = kBarcodeTimeoutSec * 2  # well past the timeout, since decode results lag behind capture
+
+kDenoiseMethods = ['gaussian', 'bilateral', 'nlm', 'none']  # RoI denoise filters, applied on grayscale
+kBackends = ['cpu', 'opencl', 'cuda']  # RoI processing backends, cuda requires OpenCV built with CUDA
 
 
 # CSV header definition
@@ -44,116 +61,403 @@ kCsvColScanTime = 'scan_time'  # initial scan time
 kCsvColUpdateTime = 'update_time'  # last row updated time
 kCsvHeaders = [kCsvColBarcode, kCsvSymbology, kCsvColCategory, kCsvColSupplierPart, kCsvColCurrQty, kCsvColDesc,
                kCsvColPackQty, kCsvColDistBarcodeData, kCsvColDistProdData, kCsvColScanTime, kCsvColUpdateTime]
+kCsvFlushRows = 8  # written rows are flushed to the file after this many rows
+kCsvFlushIntervalSec = 1.0  # or after this long, bounding how many rows could be lost on exit
 
+# scanned data prefixes for dispatch, 2-character symbology identifier prefixes are compared by slice
+kSymbologyDataMatrix = ']d'
+kSymbologyCode128 = ']C'
+kIso15434Prefix = Iso15434.kComplianceIndicator.encode('ascii')  # for raw serial data
 
-# Cross-thread queues
-data_queue = Queue()
-beep_queue = Queue()
+kSerialTimeoutSec = 0.05  # serial readline timeout, also ends scans from scanners without a LF suffix
 
 
-def scan_fn(cap: cv2.VideoCapture):
-  """Thread for scanning barcodes, enqueueing scanned barcodes
-  Handles de-duplication using a timeout between scans of the same barcode"""
-  last_seen_times = {}  # text -> time, used for scan antiduplication
+# Cross-thread queues
+data_queue = Queue()  # scanned barcodes and input lines, or None to finish writing the CSV and stop
+beep_queue = Queue(maxsize=1)  # beep requests, beeps requested while one is pending are dropped
+frame_queue = Queue(maxsize=1)  # most recent (capture time, frame) from the camera, None on capture failure
+frame_wanted = Event()  # set by the consumer when it is ready for a new frame in frame_queue
+roi_queue = Queue(maxsize=1)  # most recent (frame time, RoI, RoI thumbnail, format) pending decode
+# most recent (frame time, RoI thumbnail, format, processed RoI if debug, RoI scale, results offset, results)
+result_queue = Queue(maxsize=1)
+
+api_pool = ThreadPoolExecutor(max_workers=DigiKeyApi.kPoolSize)  # for concurrent DigiKey API requests
+
+
+def put_latest(queue: Queue, item) -> None:
+  """Puts an item into a bounded queue, dropping the oldest item if full. Only for single-producer queues."""
+  try:
+    queue.put_nowait(item)
+  except Full:
+    try:
+      queue.get_nowait()
+    except Empty:  # consumer got to it first
+      pass
+    queue.put_nowait(item)
+
+
+def capture_fn(cap: cv2.VideoCapture):
+  """Thread for grabbing frames at the camera rate, independent of how fast they are consumed.
+  Frames are only decoded (retrieved) when the consumer wants one, so skipped frames cost only the grab."""
+  while True:
+    if not cap.grab():
+      put_latest(frame_queue, None)
+      return
+    if frame_wanted.is_set():
+      capture_time = time.monotonic()
+      ret, frame = cap.retrieve()
+      if not ret:
+        put_latest(frame_queue, None)
+        return
+      frame_wanted.clear()
+      put_latest(frame_queue, (capture_time, frame))
+
+
+def denoise_roi(roi: Union[np.ndarray, cv2.UMat], denoise: str,
+                dst: Optional[np.ndarray] = None) -> Union[np.ndarray, cv2.UMat]:
+  """Denoises a grayscale RoI using one of kDenoiseMethods, optionally into a preallocated dst.
+  Non-local means is much slower than the others and usually not needed for decoding."""
+  if denoise == 'gaussian':
+    return cv2.GaussianBlur(roi, (3, 3), 0, dst=dst)
+  elif denoise == 'bilateral':
+    return cv2.bilateralFilter(roi, 5, 50, 50, dst=dst)
+  elif denoise == 'nlm':
+    return cv2.fastNlMeansDenoising(roi, dst, 10, 7, 21)
+  elif denoise == 'none':
+    return roi
+  else:
+    raise ValueError(f"unknown denoise method {denoise}")
+
+
+def cuda_denoiser(denoise: str) -> Callable[[cv2.cuda_GpuMat, cv2.cuda_GpuMat, cv2.cuda_Stream], cv2.cuda_GpuMat]:
+  """Returns a CUDA equivalent of denoise_roi, taking a grayscale RoI, dst and stream and returning the result.
+  Any filter objects are created once here."""
+  if denoise == 'gaussian':
+    gaussian = cv2.cuda.createGaussianFilter(cv2.CV_8UC1, cv2.CV_8UC1, (3, 3), 0)
+    return lambda roi, dst, stream: gaussian.apply(roi, dst, stream)
+  elif denoise == 'bilateral':
+    return lambda roi, dst, stream: cv2.cuda.bilateralFilter(roi, 5, 50, 50, dst, stream=stream)
+  elif denoise == 'nlm':
+    return lambda roi, dst, stream: cv2.cuda.fastNlMeansDenoising(roi, 10, dst, 21, 7, stream)
+  elif denoise == 'none':
+    return lambda roi, dst, stream: roi
+  else:
+    raise ValueError(f"unknown denoise method {denoise}")
+
+
+def decode_tiles(pool: ThreadPoolExecutor, roi: np.ndarray,
+                 format: zxingcpp.BarcodeFormat) -> Tuple[List[zxingcpp.Result], Tuple[int, int]]:
+  """Decodes the full RoI and four overlapping quadrants concurrently, returning the results of the first tile
+  to decode anything and that tile's (x, y) offset in the RoI.
+  Quadrants can recover barcodes that fail to decode with clutter elsewhere in the RoI."""
+  h, w = roi.shape[:2]
+  th, tw = h * 3 // 4, w * 3 // 4  # adjacent quadrants overlap by half the RoI
+  futures = {pool.submit(zxingcpp.read_barcodes, roi, formats=format): (0, 0)}
+  for x, y in [(0, 0), (w - tw, 0), (0, h - th), (w - tw, h - th)]:
+    futures[pool.submit(zxingcpp.read_barcodes, roi[y:y + th, x:x + tw], formats=format)] = (x, y)
+  for future in as_completed(futures):
+    results = future.result()
+    if results:
+      for other in futures:  # don't let unneeded tiles back up the pool
+        other.cancel()
+      return results, futures[future]
+  return [], (0, 0)
+
+
+def decode_fn(denoise: str, backend: str, tiled: bool, debug: bool):
+  """Thread for processing and decoding RoIs, so the slow denoise and decode does not block capture and display.
+  OpenCV and zxing-cpp release the GIL in their native calls, so this runs concurrently with the main thread.
+  Backend is one of kBackends, falling back to cpu if unavailable.
+  Tiled decodes the RoI and overlapping quadrants of it in parallel."""
+  if backend == 'opencl' and not cv2.ocl.haveOpenCL():
+    print("WARNING: OpenCL not available, falling back to CPU")
+    backend = 'cpu'
+  cv2.ocl.setUseOpenCL(backend == 'opencl')
+  if backend == 'cuda' and cv2.cuda.getCudaEnabledDeviceCount() == 0:
+    print("WARNING: no CUDA devices available, falling back to CPU")
+    backend = 'cpu'
+  if backend == 'cuda':
+    cuda_denoise = cuda_denoiser(denoise)
+    cuda_stream = cv2.cuda_Stream()
+    gpu_roi = cv2.cuda_GpuMat()  # upload only reallocates if the RoI size changes
+  # (h, w) -> (scaled, gray, denoised, downloaded) buffers for cuda
+  gpu_buffers: Dict[Tuple[int, int], Tuple[cv2.cuda_GpuMat, cv2.cuda_GpuMat, cv2.cuda_GpuMat, np.ndarray]] = {}
+
+  if tiled:
+    tile_pool: Optional[ThreadPoolExecutor] = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // 2))
+  else:
+    tile_pool = None
+  misses = 0  # consecutive downscaled decodes without results, held while full scale keeps finding results
+  buffers: Dict[Tuple[int, int], Tuple[np.ndarray, ...]] = {}  # (h, w) -> (scaled, gray, denoised) output buffers
+  while True:
+    frame_time, roi, thumb, format = roi_queue.get()
+    if misses >= kRoiFullScaleRetryFrames:  # in case the barcode is too fine to decode downscaled
+      scale = 1.0
+    else:
+      scale = min(1.0, kRoiMinDecodeSize / max(roi.shape[:2]))  # absolute, since the RoI scales with resolution
+
+    h, w = round(roi.shape[0] * scale), round(roi.shape[1] * scale)
+    if backend == 'opencl':  # offloaded to the GPU, only downloading the result for decoding
+      uroi = cv2.UMat(roi)
+      if scale != 1.0:
+        uroi = cv2.resize(uroi, (w, h), interpolation=cv2.INTER_AREA)
+      uroi = cv2.cvtColor(uroi, cv2.COLOR_BGR2GRAY)
+      roi = denoise_roi(uroi, denoise).get()
+    elif backend == 'cuda':  # queued on one stream, with only the RoI upload and result download crossing the bus
+      if (h, w) not in gpu_buffers:
+        gpu_buffers[(h, w)] = (cv2.cuda_GpuMat(h, w, cv2.CV_8UC3), cv2.cuda_GpuMat(h, w, cv2.CV_8UC1),
+                               cv2.cuda_GpuMat(h, w, cv2.CV_8UC1), np.empty((h, w), np.uint8))
+      gpu_scaled, gpu_gray, gpu_denoised, denoised_buf = gpu_buffers[(h, w)]
+
+      gpu_roi.upload(roi, cuda_stream)
+      gpu_in = gpu_roi
+      if scale != 1.0:
+        gpu_in = cv2.cuda.resize(gpu_roi, (w, h), dst=gpu_scaled, interpolation=cv2.INTER_AREA, stream=cuda_stream)
+      cv2.cuda.cvtColor(gpu_in, cv2.COLOR_BGR2GRAY, dst=gpu_gray, stream=cuda_stream)
+      roi = cuda_denoise(gpu_gray, gpu_denoised, cuda_stream).download(cuda_stream, denoised_buf)
+      cuda_stream.waitForCompletion()  # the download is asynchronous, so sync only before decoding
+    else:
+      if (h, w) not in buffers:  # RoI size is constant, so these are allocated once and reused across frames
+        buffers[(h, w)] = (np.empty((h, w, 3), np.uint8), np.empty((h, w), np.uint8), np.empty((h, w), np.uint8))
+      scaled_buf, gray_buf, denoised_buf = buffers[(h, w)]
+
+      if scale != 1.0:
+        roi = cv2.resize(roi, (w, h), dst=scaled_buf, interpolation=cv2.INTER_AREA)
+      roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY, dst=gray_buf)  # color is discarded anyways, so don't denoise it
+      roi = denoise_roi(roi, denoise, denoised_buf)
+    # zxing-cpp binarizes internally, and handles uneven lighting better than a pre-thresholded image
+    if tile_pool is not None:
+      results, offset = decode_tiles(tile_pool, roi, format)
+    else:
+      results, offset = zxingcpp.read_barcodes(roi, formats=format), (0, 0)
+    if scale == 1.0:
+      if not results:  # full scale didn't help either, so go back to downscaled
+        misses = 0
+      # otherwise stay at full scale while it keeps decoding, since downscaled already failed on this barcode
+    elif results:
+      misses = 0
+    else:
+      misses += 1
+    if debug:  # copy for display since the buffer is reused next frame
+      put_latest(result_queue, (frame_time, thumb, format, roi.copy(), scale, offset, results))
+    else:
+      put_latest(result_queue, (frame_time, thumb, format, None, scale, offset, results))
+
+
+def scan_fn(cap: cv2.VideoCapture, denoise: str, backend: str, tiled: bool, debug: bool,
+            console_selector: Optional[selectors.BaseSelector]):
+  """Thread for displaying captured frames, handing off the RoI to the decode thread and
+  enqueueing scanned barcodes.
+  Handles de-duplication using a timeout between scans of the same barcode.
+  If console_selector is provided, also polls console input.
+  Debug additionally displays the processed RoI and frame timing.
+  Returns when the user quits."""
+  last_seen_times = {}  # text -> monotonic time, used for scan antiduplication
   kFormats = [
     zxingcpp.BarcodeFormat.DataMatrix,
     zxingcpp.BarcodeFormat.Code128
   ]
   format = zxingcpp.BarcodeFormat.DataMatrix
 
-  cap.set(cv2.CAP_PROP_FRAME_WIDTH, kFrameWidth)  # TODO configurable
-  cap.set(cv2.CAP_PROP_FRAME_HEIGHT, kFrameHeight)
+  capture_thread = Thread(target=capture_fn, args=(cap, ))
+  capture_thread.daemon = True
+  capture_thread.start()
+
+  decode_thread = Thread(target=decode_fn, args=(denoise, backend, tiled, debug))
+  decode_thread.daemon = True
+  decode_thread.start()
+
+  # most recent decode, displayed until the next one completes
+  decoded_roi: Optional[np.ndarray] = None
+  decoded_scale = 1.0
+  decoded_offset = (0, 0)
+  results = []
+  new_texts = set()  # texts in results that were newly enqueued
+  results_text, results_text_of = '', results  # formatted results for display, and the results it was formatted from
+  results_thumb: Optional[np.ndarray] = None  # thumbnail of the RoI results were decoded from
+  results_format = format  # format results were decoded with
+  frame_shape: Optional[Tuple[int, int]] = None  # frame (h, w) the RoI geometry was calculated for
+  polypts = np.empty((4, 2), np.int32)  # barcode corners in frame coordinates, reused across barcodes
+  display_ticker = 0
+  console_pending = b''
+  last_purge_time = time.monotonic()
+  fps_frames, fps_start_time, fps_text = 0, last_purge_time, ''  # debug frame rate
 
   while True:
-    frame_time = datetime.datetime.now()
-    ticks = cv2.getTickCount()
-    ret, frame = cap.read()
-    assert ret, "failed to get frame"
-    h, w = frame.shape[:2]
+    frame_wanted.set()
+    captured = frame_queue.get()
+    assert captured is not None, "failed to get frame"
+    capture_time, frame = captured
+    if console_selector is not None:
+      console_pending = console_poll(console_selector, console_pending)
+
+    if capture_time - last_purge_time > kLastSeenPurgeIntervalSec:  # otherwise grows with every unique barcode
+      last_seen_times = {text: last_seen for text, last_seen in last_seen_times.items()
+                         if capture_time - last_seen < kLastSeenPurgeAgeSec}
+      last_purge_time = capture_time
+    if frame.shape[:2] != frame_shape:  # geometry is constant for a frame size, so only calculated on the first frame
+      frame_shape = frame.shape[:2]
+      h, w = frame_shape
+      roi_size = round(h * kRoiFrameFraction)
+      roi_x0, roi_y0 = w//2 - roi_size//2, h//2 - roi_size//2  # center-aligned RoI, also offset for results
+      roi_x1, roi_y1 = roi_x0 + roi_size, roi_y0 + roi_size
+      roi_offset = np.array([roi_x0, roi_y0], np.int32)
+      vline_p0, vline_p1 = (w//2, roi_y0), (w//2, roi_y1)  # reticule
+      hline_p0, hline_p1 = (roi_x0, h//2), (roi_x1, h//2)
 
     # only scan a small RoI since decode is extremely slow
-    roi = frame[h//2 - kRoiHeight//2 : h//2 + kRoiHeight//2,
-          w//2 - kRoiWidth//2 : w//2 + kRoiWidth//2]
-    roi = cv2.fastNlMeansDenoisingColored(roi, None, 10, 10, 7, 21)
-    roi = cv2.cvtColor(roi, cv2.COLOR_RGB2GRAY)
-    roi = cv2.adaptiveThreshold(roi, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 2)
-    # roi = cv2.threshold(roi, 63, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
-    # roi = cv2.multiply(roi, roi_msk)
-    results = zxingcpp.read_barcodes(roi, formats=format)
-
-    # display for user
-    # analysis ROI display
-    cv2.rectangle(frame, (w//2 - kRoiWidth//2, h//2 - kRoiHeight//2),
-                  (w//2 + kRoiWidth//2, h//2 + kRoiHeight//2),
-                  (255, 0, 0), 1)
-    # reticule
-    cv2.putText(frame, f"{w}x{h} {ticks}", (0, 16), cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 0, 255), 1)
-    cv2.putText(frame, f"{format}", (0, 32), cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 0, 255), 1)
-    cv2.line(frame, (w//2, h//2 - kRoiHeight//2), (w//2, h//2 + kRoiHeight//2), (0, 0, 255), 1)
-    cv2.line(frame, (w//2 - kRoiWidth//2, h//2), (w//2 + kRoiWidth//2, h//2), (0, 0, 255), 1)
-
-    cv2.putText(frame, f"{results}", (w//2 - kRoiWidth//2, h//2 + kRoiHeight//2),
-                cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 0, 255), 1)
-
-    woff = w//2 - kRoiWidth//2  # correct for RoI
-    hoff = h//2 - kRoiHeight//2
-
-    def zxing_pos_to_cv2(pos):
-      return (woff + pos.x, hoff + pos.y)
-
-    for barcode in results:
-      last_seen = last_seen_times.get(barcode.text, datetime.datetime(1990, 1, 1))
-      if frame_time - last_seen > kBarcodeTimeoutThreshold:
-        print(f"{barcode.symbology_identifier}: {barcode.text}")
-        beep_queue.put(1)
-        data_queue.put(barcode)
-        frame_thick = 4
-      else:
-        frame_thick = 1
-      last_seen_times[barcode.text] = frame_time
-
-      pos = barcode.position
-      polypts = np.array([zxing_pos_to_cv2(xy)
-                          for xy in [pos.top_left, pos.top_right, pos.bottom_right, pos.bottom_left]], np.int32)
-      cv2.polylines(frame, [polypts], isClosed=True, color=(0, 255, 0), thickness=frame_thick)
-      cv2.putText(frame, f"{barcode.text}", (woff + pos.top_left.x, hoff + pos.top_left.y),
-                  cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 255, 0), 1)
-
-    cv2.imshow(kWindowName, frame)
-    cv2.imshow(kWindowName + "b", roi)
-    key = cv2.waitKey(1)  # delay
+    # contiguous copy since the frame is drawn on below, while the decode thread may still be using the RoI
+    roi = np.ascontiguousarray(frame[roi_y0:roi_y1, roi_x0:roi_x1], dtype=np.uint8)
+
+    thumb = cv2.cvtColor(cv2.resize(roi, kStaticThumbSize, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    # compared against the decoded RoI rather than the previous frame, so slow changes still accumulate
+    # and against the decoded format, so switching formats re-decodes immediately
+    static = (results_thumb is not None and results_format == format
+              and cv2.absdiff(thumb, results_thumb).mean() < kStaticDiffThreshold)
+
+    if cv2.meanStdDev(roi)[1].max() < kBlankStdThreshold:  # eg no part in view, nothing to decode
+      results = []
+    elif static and results:  # unchanged since barcodes were last decoded, so they are still in view
+      for barcode in results:
+        last_seen_times[barcode.text] = capture_time
+    else:
+      put_latest(roi_queue, (capture_time, roi, thumb, format))  # if the decode thread is busy, replace the stale RoI
+
+    while True:  # not checking empty() first, since put_latest may take the item back to replace it
+      try:
+        (frame_time, results_thumb, results_format, decoded_roi, decoded_scale, decoded_offset,
+         results) = result_queue.get_nowait()
+      except Empty:
+        break
+      new_texts = set()
+      for barcode in results:
+        last_seen = last_seen_times.get(barcode.text, float('-inf'))
+        if frame_time - last_seen > kBarcodeTimeoutSec:
+          print(f"{barcode.symbology_identifier}: {barcode.text}")
+          try:
+            beep_queue.put_nowait(None)
+          except Full:  # one beep is enough for a burst of scans
+            pass
+          data_queue.put(barcode)
+          new_texts.add(barcode.text)
+        last_seen_times[barcode.text] = frame_time
+
+    if debug:
+      fps_frames += 1
+      if capture_time - fps_start_time >= kFpsIntervalSec:
+        fps_text = f"{w}x{h} {fps_frames / (capture_time - fps_start_time):.1f} fps"
+        fps_frames, fps_start_time = 0, capture_time
+
+    display_ticker += 1
+    if display_ticker % kDisplayEveryFrames != 0:  # skip drawing and displaying this frame, but still handle keys
+      key = cv2.pollKey()
+    else:
+      # display for user
+      # analysis ROI display
+      cv2.rectangle(frame, (roi_x0, roi_y0), (roi_x1, roi_y1), (255, 0, 0), 1)
+      # reticule
+      if debug:
+        cv2.putText(frame, fps_text, (0, 16), cv2.FONT_HERSHEY_SIMPLEX, kFontScale,
+                    (0, 0, 255), 1)
+      cv2.putText(frame, f"{format}", (0, 32), cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 0, 255), 1)
+      cv2.line(frame, vline_p0, vline_p1, (0, 0, 255), 1)
+      cv2.line(frame, hline_p0, hline_p1, (0, 0, 255), 1)
+
+      if results:
+        if results is not results_text_of:  # only reformat when a new decode is drained, payloads can be long
+          results_text, results_text_of = f"{results}", results
+        cv2.putText(frame, results_text, (roi_x0, roi_y1),
+                    cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 0, 255), 1)
+
+      for barcode in results:
+        if barcode.text in new_texts:
+          frame_thick = 4
+        else:
+          frame_thick = 1
+
+        pos = barcode.position
+        polypts[0] = pos.top_left.x, pos.top_left.y
+        polypts[1] = pos.top_right.x, pos.top_right.y
+        polypts[2] = pos.bottom_right.x, pos.bottom_right.y
+        polypts[3] = pos.bottom_left.x, pos.bottom_left.y
+        polypts += decoded_offset  # correct for decoded tile
+        if decoded_scale != 1.0:  # undo the decode downscaling
+          np.divide(polypts, decoded_scale, out=polypts, casting='unsafe')
+        polypts += roi_offset  # correct for RoI
+        cv2.polylines(frame, [polypts], isClosed=True, color=(0, 255, 0), thickness=frame_thick)
+        cv2.putText(frame, f"{barcode.text}", (int(polypts[0, 0]), int(polypts[0, 1])),
+                    cv2.FONT_HERSHEY_SIMPLEX, kFontScale, (0, 255, 0), 1)
+
+      cv2.imshow(kWindowName, frame)
+      if debug and decoded_roi is not None:
+        cv2.imshow(kWindowName + "b", decoded_roi)
+      key = cv2.waitKey(1)  # delay
     if key == ord('q'):
-      sys.exit(0)
+      return
     elif key == ord('f'):
       format = kFormats[(kFormats.index(format) + 1) % len(kFormats)]
 
 
 def console_fn():
-  """Thread that handles user input, enueueing each user-inputted line"""
+  """Thread that handles user input, enueueing each user-inputted line.
+  Only used where stdin can't be polled (Windows, or redirected from a file), otherwise see console_poll."""
   while True:
     userline = input()
     data_queue.put(userline)
 
 
+def console_poll(selector: selectors.BaseSelector, pending: bytes) -> bytes:
+  """Non-blocking alternative to console_fn for polling from the main loop, enqueueing each complete
+  user-inputted line. Returns any incomplete line, to be passed into the next call."""
+  if selector.select(timeout=0):
+    data = os.read(sys.stdin.fileno(), 4096)  # read directly, since buffered stdin could hide lines from select
+    if not data:  # EOF
+      selector.unregister(sys.stdin)
+    *lines, pending = (pending + data).split(b'\n')
+    for line in lines:
+      data_queue.put(line.decode('utf-8', errors='replace').rstrip('\r'))  # don't let bad input stop scanning
+  return pending
+
+
 def csv_fn(csv_filename: str):
   """Data handling thread that mixes scanned barcodes and user input, writing data to a CSV file"""
   with open(csv_filename, 'r', newline='', encoding='utf-8') as csvfile:
     csvr = csv.DictReader(csvfile)
-    records = {row[kCsvColBarcode]: row for row in csvr}
+    records = {row[kCsvColBarcode] for row in csvr}  # only keys are needed, for duplicate checking
     fieldnames = csvr.fieldnames
     print(f"loaded {len(records)} rows, fieldnames {fieldnames} from existing CSV")
 
   with open(csv_filename, 'a', newline='', encoding='utf-8') as csvfile:
     csvw = csv.DictWriter(csvfile, fieldnames=fieldnames)
     curr_dict: Optional[Dict[str, str]] = None  # none if no part active
+    curr_lookup: Optional[Future] = None  # in-progress API lookup populating curr_dict, if any
+    unflushed_rows = 0
+    last_flush_time = time.monotonic()
+
+    def flush():
+      nonlocal unflushed_rows, last_flush_time
+      csvfile.flush()
+      unflushed_rows = 0
+      last_flush_time = time.monotonic()
+
+    def wait_lookup():
+      nonlocal curr_lookup
+      if curr_lookup is not None:
+        curr_lookup.result()
+        curr_lookup = None
 
     def write_line():
+      nonlocal unflushed_rows
+      wait_lookup()
       if curr_dict is not None:  # commit prev line
         csvw.writerow(curr_dict)
-        csvfile.flush()
-        records[curr_dict[kCsvColBarcode]] = curr_dict
+        unflushed_rows += 1
+        if unflushed_rows >= kCsvFlushRows or time.monotonic() - last_flush_time > kCsvFlushIntervalSec:
+          flush()
+        records.add(curr_dict[kCsvColBarcode])
 
-    def process_iso15434(barcode_raw: str, decoded: Iso15434, curr_dict: Dict[str, str]):
+    def process_iso15434(barcode_raw: str, decoded: Iso15434, curr_dict: Dict[str, str]) -> Future:
+      """Populates curr_dict from the barcode, returning the Future of the API lookup populating the rest."""
       if '20Z' in decoded.data:
         distributor = 'DigiKey2d'
       else:
@@ -163,11 +467,24 @@ def csv_fn(csv_filename: str):
       curr_dict[kCsvColPackQty] = decoded.data[FieldQuantity].raw
 
       print(f"{distributor} {curr_dict[kCsvColSupplierPart]} x {curr_dict[kCsvColPackQty]}")
+      dk_speculative_term: Optional[str] = None
+      dk_speculative_product: Optional[Future] = None
+      if distributor == 'DigiKey2d' and FieldCustomerPartNumber in decoded.data:
+        # DigiKey barcodes contain the DigiKey part number, so speculatively look up product details concurrently
+        # with the barcode lookup, which is used if the barcode lookup returns the same part number.
+        # Submitted before the lookup that waits on it, so it is never stuck queued behind waiting lookups.
+        dk_speculative_term = decoded.data[FieldCustomerPartNumber].raw
+        dk_speculative_product = api_pool.submit(digikey_api.product_details, dk_speculative_term)
+      return api_pool.submit(lookup_iso15434, barcode_raw, distributor, curr_dict,
+                             dk_speculative_term, dk_speculative_product)
+
+    def lookup_iso15434(barcode_raw: str, distributor: str, curr_dict: Dict[str, str],
+                        dk_speculative_term: Optional[str], dk_speculative_product: Optional[Future]):
       if distributor == 'DigiKey2d':
         try:
           dk_barcode2d = digikey_api.barcode2d(barcode_raw)
           dk_searchterm = dk_barcode2d.DigiKeyPartNumber
-          curr_dict[kCsvColDistBarcodeData] = dk_barcode2d.model_dump_json()
+          curr_dict[kCsvColDistBarcodeData] = dk_barcode2d.model_dump_json_cached()
         except AssertionError as e:
           print(f"WARNING: barcode lookup failed: {e}")
           dk_searchterm = curr_dict[kCsvColSupplierPart]
@@ -175,18 +492,48 @@ def csv_fn(csv_filename: str):
         dk_searchterm = curr_dict[kCsvColSupplierPart]
 
       try:
-        dk_product = digikey_api.product_details(dk_searchterm)
-        curr_dict[kCsvColDistProdData] = dk_product.model_dump_json()
+        if dk_speculative_product is not None and dk_searchterm == dk_speculative_term:
+          dk_product = dk_speculative_product.result()
+        else:
+          dk_product = digikey_api.product_details(dk_searchterm)
+        curr_dict[kCsvColDistProdData] = dk_product.model_dump_json_cached()
         curr_dict[kCsvColDesc] = dk_product.Product.Description.ProductDescription
         curr_dict[kCsvColCategory] = dk_product.Product.Category.simple_str()
         print(f"{curr_dict[kCsvColDesc]}, {curr_dict[kCsvColCategory]}")
       except AssertionError as e:
         print(f"WARNING: product lookup failed, fields not populated: {e}")
 
+    def lookup_barcode1d(barcode_raw: str, curr_dict: Dict[str, str]):
+      try:
+        dk_barcode1d = digikey_api.barcode(barcode_raw)
+        dk_searchterm = dk_barcode1d.DigiKeyPartNumber
+        curr_dict[kCsvColDistBarcodeData] = dk_barcode1d.model_dump_json_cached()
+        curr_dict[kCsvColSupplierPart] = dk_barcode1d.ManufacturerPartNumber
+        curr_dict[kCsvColPackQty] = dk_barcode1d.Quantity
 
-    while True:
-      data = data_queue.get()
+        dk_product = digikey_api.product_details(dk_searchterm)
+        curr_dict[kCsvColDistProdData] = dk_product.model_dump_json_cached()
+        curr_dict[kCsvColDesc] = dk_product.Product.Description.ProductDescription
+        curr_dict[kCsvColCategory] = dk_product.Product.Category.simple_str()
+        print(f"Digikey1d {curr_dict[kCsvColSupplierPart]} x {curr_dict[kCsvColPackQty]}")
+        print(f"{curr_dict[kCsvColDesc]}, {curr_dict[kCsvColCategory]}")
+      except AssertionError as e:
+        print(f"WARNING: product lookup failed, fields not populated: {e}")
 
+    # API lookups run in the background so input can still be processed, but are finished before the line is
+    # committed or their fields are needed
+    while True:
+      try:
+        data = data_queue.get(timeout=kCsvFlushIntervalSec)
+      except Empty:  # idle, so flush any rows written in a burst
+        if unflushed_rows:
+          flush()
+        continue
+
+      if data is None:  # shutting down, so make sure committed rows aren't lost in the buffer
+        wait_lookup()
+        flush()
+        return
       if isinstance(data, str):
         if not data and curr_dict is not None:  # return to commit line
           write_line()
@@ -194,12 +541,15 @@ def csv_fn(csv_filename: str):
           print(f"line saved")
         elif data.startswith('d') and curr_dict is not None:
           curr_dict = None
+          curr_lookup = None  # abandoned, populating the discarded dict
           print(f"line deleted")
         elif data.startswith('+') or data.startswith('-') or data == '0':
           if data.startswith('+'):
             data = data[1:]
           try:
             qtymod = int(data)
+            if kCsvColCurrQty not in curr_dict and kCsvColPackQty not in curr_dict:
+              wait_lookup()  # pack quantity may come from the lookup
             curr_qty = int(curr_dict.get(kCsvColCurrQty, curr_dict[kCsvColPackQty])) + qtymod
             curr_dict[kCsvColCurrQty] = str(curr_qty)
             print(f"Updated quantity to {curr_qty}")
@@ -207,9 +557,10 @@ def csv_fn(csv_filename: str):
             print(f"unknown quantity modifier {data}")
         elif data.startswith('p') and curr_dict is not None:
           data = data[1:]
+          wait_lookup()  # so it doesn't overwrite these fields
           try:
             dk_product = digikey_api.product_details(data)
-            curr_dict[kCsvColDistProdData] = dk_product.model_dump_json()
+            curr_dict[kCsvColDistProdData] = dk_product.model_dump_json_cached()
             curr_dict[kCsvColDesc] = dk_product.Product.Description.ProductDescription
             curr_dict[kCsvColCategory] = dk_product.Product.Category.simple_str()
             print(f"{[kCsvColDesc]}, {curr_dict[kCsvColCategory]}")
@@ -218,7 +569,7 @@ def csv_fn(csv_filename: str):
         else:
           print(f"unknown command {data}")
       elif isinstance(data, bytes):  # from serial;
-        if data.startswith(b'[)>'):
+        if data.startswith(kIso15434Prefix):
           write_line()
           curr_dict = None
           barcode_raw = data.decode('utf-8')
@@ -230,7 +581,7 @@ def csv_fn(csv_filename: str):
                        kCsvColScanTime: datetime.datetime.now().isoformat()}
           decoded = Iso15434.from_data(barcode_raw)
           if decoded is not None:
-            process_iso15434(barcode_raw, decoded, curr_dict)
+            curr_lookup = process_iso15434(barcode_raw, decoded, curr_dict)
           else:
             print(f"failed to decode iso15434")
         else:
@@ -243,42 +594,47 @@ def csv_fn(csv_filename: str):
         if barcode_key in records:
           print("WARNING: duplicate row")
 
+        symbology = data.symbology_identifier
         curr_dict = {kCsvColBarcode: barcode_key,
-                     kCsvSymbology: data.symbology_identifier,
+                     kCsvSymbology: symbology,
                      kCsvColScanTime: datetime.datetime.now().isoformat()}
-        if data.symbology_identifier.startswith(']d'):
+        if symbology[:2] == kSymbologyDataMatrix:
           decoded = Iso15434.from_data(data.text)
           if decoded is not None:
-            process_iso15434(barcode_raw, decoded, curr_dict)
+            curr_lookup = process_iso15434(barcode_raw, decoded, curr_dict)
           else:
             print(f"failed to decode iso15434")
-        elif data.symbology_identifier.startswith(']C'):
-          try:
-            dk_barcode1d = digikey_api.barcode(barcode_raw)
-            dk_searchterm = dk_barcode1d.DigiKeyPartNumber
-            curr_dict[kCsvColDistBarcodeData] = dk_barcode1d.model_dump_json()
-            curr_dict[kCsvColSupplierPart] = dk_barcode1d.ManufacturerPartNumber
-            curr_dict[kCsvColPackQty] = dk_barcode1d.Quantity
-
-            dk_product = digikey_api.product_details(dk_searchterm)
-            curr_dict[kCsvColDistProdData] = dk_product.model_dump_json()
-            curr_dict[kCsvColDesc] = dk_product.Product.Description.ProductDescription
-            curr_dict[kCsvColCategory] = dk_product.Product.Category.simple_str()
-            print(f"Digikey1d {curr_dict[kCsvColSupplierPart]} x {curr_dict[kCsvColPackQty]}")
-            print(f"{curr_dict[kCsvColDesc]}, {curr_dict[kCsvColCategory]}")
-          except AssertionError as e:
-            print(f"WARNING: product lookup failed, fields not populated: {e}")
-
+        elif symbology[:2] == kSymbologyCode128:
+          curr_lookup = api_pool.submit(lookup_barcode1d, barcode_raw, curr_dict)
         else:
-          print(f"unknown symbology {data.symbology_identifier} {data.text}")
+          print(f"unknown symbology {symbology} {data.text}")
+
+
+def make_beep() -> simpleaudio.WaveObject:
+  """Synthesizes the scan beep from kBeepNotes, each note decaying so they don't click at the transitions."""
+  notes = []
+  for frequency, duration in kBeepNotes:
+    t = np.arange(round(kBeepSampleRate * duration)) / kBeepSampleRate
+    notes.append(np.sin(2 * np.pi * frequency * t) * np.exp(-t * 4 / duration))
+  samples = (np.concatenate(notes) * 0.5 * np.iinfo(np.int16).max).astype(np.int16)
+  return simpleaudio.WaveObject(samples.tobytes(), num_channels=1, bytes_per_sample=2, sample_rate=kBeepSampleRate)
 
 
 def beep_fn():
+  """Thread for playing beeps. The sound is synthesized once and played without waiting for it to finish.
+  Beeps requested while the previous one is still playing are dropped instead of overlapping."""
+  beep = make_beep()
+  playing: Optional[simpleaudio.PlayObject] = None
   while True:
-    beepy.beep(sound=beep_queue.get())  # beep seems to be blocking, so it gets its own thread
+    beep_queue.get()
+    if playing is not None and playing.is_playing():
+      continue
+    playing = beep.play()
 
 
 def serial_fn(port: serial.Serial):
+  """Thread for reading lines from a serial barcode scanner, enqueueing each non-empty line.
+  readline returns on LF or timeout, so scanners with other suffixes are delivered after kSerialTimeoutSec."""
   while True:
     s = port.readline()
     if s:
@@ -293,6 +649,18 @@ if __name__ == '__main__':
                       help='CSV filename to create / append.')
   parser.add_argument('--serial', type=str,
                       help='Optional serial port for a connected barcode scanner.')
+  parser.add_argument('--frame-width', type=int, default=kFrameWidth,
+                      help='Camera capture width.')
+  parser.add_argument('--frame-height', type=int, default=kFrameHeight,
+                      help='Camera capture height.')
+  parser.add_argument('--denoise', type=str, choices=kDenoiseMethods, default='gaussian',
+                      help='RoI denoise filter before decoding, nlm is highest quality but much slower.')
+  parser.add_argument('--backend', type=str, choices=kBackends, default='cpu',
+                      help='RoI processing backend, opencl may offload to a GPU and cuda processes on an NVIDIA GPU.')
+  parser.add_argument('--tiled', action='store_true',
+                      help='Additionally decode overlapping RoI quadrants in parallel, using more CPU cores.')
+  parser.add_argument('--debug', action='store_true',
+                      help='Display the processed RoI and frame timing.')
   args = parser.parse_args()
 
   # initialize Digikey API
@@ -314,15 +682,33 @@ if __name__ == '__main__':
   # initialize OpenCV
   cap = cv2.VideoCapture(0)  # TODO configurable
   assert cap.isOpened, "failed to open camera"
+  # request compressed frames, otherwise most webcams default to raw YUYV which is bandwidth-limited at high resolution
+  kFourccMjpg = cv2.VideoWriter_fourcc(*'MJPG')
+  cap.set(cv2.CAP_PROP_FOURCC, kFourccMjpg)
+  cap.set(cv2.CAP_PROP_FRAME_WIDTH, args.frame_width)
+  cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args.frame_height)
+  cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)  # minimize driver-side queueing of stale frames, not supported by all backends
+  if int(cap.get(cv2.CAP_PROP_FOURCC)) != kFourccMjpg:
+    print("WARNING: camera does not support MJPG, capture may be slow")
 
   if args.serial:
-    port = serial.Serial(args.serial, timeout=0.05)
+    port = serial.Serial(args.serial, timeout=kSerialTimeoutSec)
     serial_thread = Thread(target=serial_fn, args=(port, ))
     serial_thread.daemon = True
     serial_thread.start()
 
-  console_thread = Thread(target=console_fn)
-  console_thread.start()
+  console_selector: Optional[selectors.BaseSelector] = None  # polled from the main thread where supported
+  if sys.platform != 'win32':  # selectors doesn't support stdin on Windows
+    console_selector = selectors.DefaultSelector()
+    try:
+      console_selector.register(sys.stdin, selectors.EVENT_READ)
+    except (OSError, ValueError):  # eg stdin redirected from a file or /dev/null, which can't be polled
+      console_selector.close()
+      console_selector = None
+  if console_selector is None:
+    console_thread = Thread(target=console_fn)
+    console_thread.daemon = True
+    console_thread.start()
 
   csv_thread = Thread(target=csv_fn, args=(args.csv, ))
   csv_thread.daemon = True
@@ -332,4 +718,6 @@ if __name__ == '__main__':
   beep_thread.daemon = True
   beep_thread.start()
 
-  scan_fn(cap)  # becomes the main thread for user input because it handles the exit function
+  scan_fn(cap, args.denoise, args.backend, args.tiled, args.debug, console_selector)  # becomes the main thread for user input because it handles the exit function
+  data_queue.put(None)  # other threads are daemons, but csv_fn may have rows to flush
+  csv_thread.join()
@@ -0,0 +1,51 @@
+import unittest
+
+import orjson
+
+from digikey_api import construct_model, CategoryNode, ProductDetails
+
+
+class ConstructModelTestCase(unittest.TestCase):
+  kProductDetails = {
+    "Product": {
+      "Description": {
+        "ProductDescription": "RES 5.1K OHM 1% 1/10W 0603",
+        "DetailedDescription": "5.1 kOhms ±1% 0.1W, 1/10W Chip Resistor 0603 (1608 Metric) Automotive AEC-Q200"
+      },
+      "Manufacturer": {"Id": 2, "Name": "Stackpole Electronics Inc"},
+      "ManufacturerProductNumber": "RMCF0603FT5K10",
+      "UnitPrice": 0.1,
+      "ProductUrl": "https://www.digikey.com/en/products/detail/stackpole-electronics-inc/RMCF0603FT5K10/1761175",
+      "DatasheetUrl": None,
+      "QuantityAvailable": 1289870,
+      "Discontinued": False,
+      "Category": {
+        "CategoryId": 2, "ParentId": 0, "Name": "Resistors", "ProductCount": 1000, "NewProductCount": 10,
+        "ImageUrl": "", "SeoDescription": "",
+        "ChildCategories": [{
+          "CategoryId": 52, "ParentId": 2, "Name": "Chip Resistor - Surface Mount", "ProductCount": 900,
+          "NewProductCount": 9, "ImageUrl": "", "SeoDescription": "", "ChildCategories": []
+        }]
+      },
+      "ManufacturerLeadWeeks": "11 Weeks",
+      "ManufacturerPublicQuantity": 0,
+      "Series": {"Id": 1, "Name": "RMCF"}  # not modeled, kept as an extra field
+    }
+  }
+
+  def test_product_details(self):
+    constructed = construct_model(ProductDetails, self.kProductDetails)
+    validated = ProductDetails.model_validate_json(orjson.dumps(self.kProductDetails))
+    self.assertEqual(constructed.model_dump_json(), validated.model_dump_json())
+
+    self.assertIsInstance(constructed.Product.Category.ChildCategories[0], CategoryNode)
+    self.assertEqual(constructed.Product.Category.simple_str(), "Resistors - Chip Resistor - Surface Mount")
+    self.assertEqual(constructed.Product.Manufacturer.Name, "Stackpole Electronics Inc")
+    self.assertIsNone(constructed.Product.DatasheetUrl)  # explicit null
+    self.assertIsNone(constructed.Product.PhotoUrl)  # absent, defaulted
+    self.assertEqual(constructed.Product.Series, {"Id": 1, "Name": "RMCF"})
+
+  def test_cached_json(self):
+    constructed = construct_model(ProductDetails, self.kProductDetails)
+    self.assertIs(constructed.model_dump_json_cached(), constructed.model_dump_json_cached())
+    self.assertEqual(constructed.model_dump_json_cached(), constructed.model_dump_json())
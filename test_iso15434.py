@@ -30,3 +30,15 @@ class Iso15434TestCase(unittest.TestCase):
     self.assertEqual(parsed.data[FieldSupplierPartNumber].raw, "FH12-15S-0.5SH(55)")
     self.assertEqual(parsed.data[FieldManufacturer].raw, "Hirose")
     self.assertEqual(parsed.data[FieldQuantity].raw, "2")
+
+  def test_empty_element(self):
+    input = "[)>␞06␝␝1PXAF4444␝12␝Q3␞␄"
+    parsed = Iso15434.from_data(input)
+    self.assertNotEqual(parsed, None)
+    self.assertEqual(parsed.data[FieldSupplierPartNumber].raw, "XAF4444")
+    self.assertEqual(parsed.data[FieldQuantity].raw, "3")
+    self.assertEqual(len(parsed.data), 2)
+
+  def test_cached(self):
+    input = "[)>␞06␝K0160NLA52600␝14K002␝1PFH12-15S-0.5SH(55)␝Q2␝11K069808311␝4LJP␝1VHirose␞␄"
+    self.assertIs(Iso15434.from_data(input), Iso15434.from_data(input))